@@ -1,17 +1,22 @@
 import os
+import asyncio
 import logging
+import queue
+import base64
 import sqlite3
+import functools
+import contextlib
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
-    MessageHandler,
     ContextTypes,
-    filters,
 )
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-BOT_USERNAME = os.getenv("BOT_USERNAME")
+# Filled in from get_me() in post_init
+BOT_USERNAME = None
+LINK_PREFIX = None
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(message)s",
@@ -19,22 +24,108 @@ logging.basicConfig(
 )
 
 # -------------------- DB --------------------
-conn = sqlite3.connect("filestore.db")
-cur = conn.cursor()
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS files(
-    code TEXT PRIMARY KEY,
-    file_id TEXT,
-    caption TEXT,
-    file_type TEXT
+DB_FILE = "filestore.db"
+
+# Keep SQL in constants with ? placeholders; never build it with f-strings,
+# or every call gets a fresh string that misses the statement cache.
+SQL_INSERT_FILE = (
+    "INSERT INTO files VALUES (?, ?, ?, ?) ON CONFLICT(code) DO NOTHING"
 )
-""")
-conn.commit()
+SQL_FIND_FILE = "SELECT file_id, caption, file_type FROM files WHERE code=?"
+
+
+class SqlitePool:
+    """One writer connection plus a few read-only readers.
+
+    WAL lets the readers run alongside the writer, so lookups running in
+    worker threads never queue behind an insert. Writers are serialized by
+    the caller holding ``write_lock``.
+    """
+
+    def __init__(self, path, readers=4):
+        self._writer = self._connect(path)
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            c = self._connect(path)
+            c.execute("PRAGMA query_only=1")
+            self._readers.put(c)
+
+    @staticmethod
+    def _connect(path):
+        c = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute("PRAGMA temp_store=MEMORY")
+        c.execute("PRAGMA cache_size=-20000")
+        c.execute("PRAGMA mmap_size=134217728")
+        c.execute("PRAGMA busy_timeout=5000")
+        return c
+
+    @contextlib.contextmanager
+    def writer(self):
+        yield self._writer
+
+    @contextlib.contextmanager
+    def reader(self):
+        c = self._readers.get()
+        try:
+            yield c
+        finally:
+            self._readers.put(c)
+
+
+db = None
+write_lock = asyncio.Lock()
+
+
+def init_db():
+    global db
+    db = SqlitePool(DB_FILE)
+
+    with db.writer() as c, c:
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS files(
+            code TEXT PRIMARY KEY,
+            file_id TEXT,
+            caption TEXT,
+            file_type TEXT
+        )
+        """)
+
+
+def gen_code():
+    # 40 random bits -> 8 base32 chars, from a single urandom call
+    return base64.b32encode(os.urandom(5)).decode()
+
+
+# Blocking sqlite calls; handlers run these via asyncio.to_thread so the
+# event loop keeps serving other updates.
+def save_file(file_id, caption, file_type):
+    with db.writer() as c:
+        while True:
+            code = gen_code()
+            with c:
+                cur = c.execute(SQL_INSERT_FILE, (code, file_id, caption, file_type))
+            if cur.rowcount:  # 0 means the code was taken, re-roll
+                return code
+
+
+# Codes never change once stored, so hits are cached. Misses raise
+# KeyError, which lru_cache does not memoize.
+@functools.lru_cache(maxsize=4096)
+def get_file(code):
+    with db.reader() as c:
+        row = c.execute(SQL_FIND_FILE, (code,)).fetchone()
+    if row is None:
+        raise KeyError(code)
+    return row
 
 
 # -------------------- COMMANDS --------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args:
+        return await deep_link(update, context)
+
     await update.message.reply_text(
         "Hello! Send a file and then use:\n"
         "filestore – to generate link for that file\n"
@@ -48,31 +139,32 @@ async def filestore(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("Reply to a file!")
 
     msg = update.message.reply_to_message
-    code = os.urandom(4).hex()
     file_id, caption, file_type = extract_file(msg)
 
-    cur.execute("INSERT INTO files VALUES (?, ?, ?, ?)",
-                (code, file_id, caption, file_type))
-    conn.commit()
+    async with write_lock:
+        code = await asyncio.to_thread(save_file, file_id, caption, file_type)
 
-    link = f"https://t.me/{BOT_USERNAME}?start={code}"
+    link = LINK_PREFIX + code
     await update.message.reply_text(f"Stored!\nLink: {link}")
 
 
 # -------------------- FILE EXTRACTOR --------------------
+# (message attribute / file_type, file_id getter, keeps caption), in priority order
+_EXTRACTORS = (
+    ("document", lambda v: v.file_id, True),
+    ("photo", lambda v: v[-1].file_id, True),
+    ("video", lambda v: v.file_id, True),
+    ("audio", lambda v: v.file_id, True),
+    ("voice", lambda v: v.file_id, True),
+    ("sticker", lambda v: v.file_id, False),
+)
+
+
 def extract_file(msg):
-    if msg.document:
-        return msg.document.file_id, msg.caption, "document"
-    if msg.photo:
-        return msg.photo[-1].file_id, msg.caption, "photo"
-    if msg.video:
-        return msg.video.file_id, msg.caption, "video"
-    if msg.audio:
-        return msg.audio.file_id, msg.caption, "audio"
-    if msg.voice:
-        return msg.voice.file_id, msg.caption, "voice"
-    if msg.sticker:
-        return msg.sticker.file_id, None, "sticker"
+    for file_type, get_id, has_caption in _EXTRACTORS:
+        media = getattr(msg, file_type)
+        if media:
+            return get_id(media), msg.caption if has_caption else None, file_type
     return None, None, None
 
 
@@ -83,14 +175,11 @@ async def deep_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     code = context.args[0]
 
-    cur.execute("SELECT file_id, caption, file_type FROM files WHERE code=?", (code,))
-    row = cur.fetchone()
-
-    if not row:
+    try:
+        file_id, caption, file_type = await asyncio.to_thread(get_file, code)
+    except KeyError:
         return await update.message.reply_text("Invalid or expired link!")
 
-    file_id, caption, file_type = row
-
     if file_type == "photo":
         await update.message.reply_photo(file_id, caption=caption)
     elif file_type == "document":
@@ -106,12 +195,20 @@ async def deep_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # -------------------- MAIN --------------------
+async def post_init(app):
+    global BOT_USERNAME, LINK_PREFIX
+    me = await app.bot.get_me()
+    BOT_USERNAME = me.username
+    LINK_PREFIX = f"https://t.me/{BOT_USERNAME}?start="
+
+
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    init_db()
+
+    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("filestore", filestore))
-    app.add_handler(MessageHandler(filters.Regex("^/start ") & filters.TEXT, deep_link))
 
     app.run_polling()
 